@@ -1,12 +1,30 @@
+import os
 import re
+import json
 import time
+import uuid
+import pickle
 import yaml
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from flask import Flask, render_template, request, redirect, url_for, flash
+import threading
+import functools
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context
+from flask_compress import Compress
+from werkzeug.routing import BaseConverter, ValidationError
 from netmiko import ConnectHandler
 from cachetools import TTLCache
-from config import APP_HOST, APP_PORT, DEBUG, SECRET_KEY, TDR_CACHE_TTL, INTERFACES_CACHE_TTL, MAX_WORKERS
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
+from config import APP_HOST, APP_PORT, DEBUG, SECRET_KEY, TDR_CACHE_TTL, INTERFACES_CACHE_TTL, MAX_WORKERS, TDR_POLL_DELAYS
+from config import MAC_CACHE_TTL, CACHE_BACKEND, CACHE_DIR, CACHE_SIZE_LIMIT, REDIS_URL, SINGLEFLIGHT_LOCK_TTL
+from config import PREFETCH_ON_STARTUP
+from config import CONNECTION_POOL_IDLE_TIMEOUT, CONNECTION_POOL_MAX_AGE, CONNECTION_POOL_MAX_SIZE
+from config import CONNECTION_POOL_MAX_IDLE_PER_HOST, CONNECTION_POOL_MAX_ACTIVE_PER_HOST
 
 # Configure logging
 logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -15,6 +33,25 @@ logger.setLevel(logging.INFO if not DEBUG else logging.DEBUG)
 netmiko_logger = logging.getLogger("netmiko")
 #netmiko_logger.setLevel(logging.DEBUG)  # Uncomment for Netmiko debug logging
 
+# Precompiled patterns for output parsing
+_PAIR_RE = re.compile(r".{0,25}Pair\s+([A-D])[:\-\s]*(.*)", re.IGNORECASE)
+_LEN_STATUS_RE = re.compile(
+    r"(?P<len>\d+(?:\.\d+)?)(?:\s*\+\/\-\s*\d*)?\s*(?:m|meters|meter|m\.)"
+    r"|(?P<status>open|short|ok|normal|fault|not supported|unsupported|no tdr)",
+    re.IGNORECASE,
+)
+_TDR_PENDING_RE = re.compile(r"in[\s-]progress|not complete", re.IGNORECASE)
+_TDR_DONE_RE = re.compile(r"last run on|Pair\s+[A-D]\b", re.IGNORECASE)
+_IFACE_TOKEN_RE = re.compile(r"^(Gi|Fa|Te|Tw|Et|Ethernet|Po|Port-channel|Eth)\S*|^[A-Za-z]+[0-9/]+$", re.IGNORECASE)
+_MAC_STRIP_RE = re.compile(r"[^0-9a-fA-F]")
+# Cheap pre-check for _IFACE_TOKEN_RE: a token can only match if it starts with one of
+# these prefixes or ends in a digit or slash (generic branch)
+_IFACE_PREFIXES_LC = ("gi", "fa", "te", "tw", "et", "po", "eth")
+_IFACE_TAIL_CHARS = frozenset("0123456789/")
+
+def maybe_iface_token(token):
+    return token[:1].isalpha() and (token.lower().startswith(_IFACE_PREFIXES_LC) or token[-1] in _IFACE_TAIL_CHARS)
+
 NETMIKO_ALLOWED_KEYS = {
     "device_type", "host", "username", "password", "secret", "allow_agent",
     "port", "verbose", "session_log", "timeout", "conn_timeout",
@@ -34,230 +71,787 @@ def sanitize_device_for_netmiko(device):
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
+Compress(app)
 
 # Load inventory with multiple sites
 with open("inventory.yaml") as f:
-    INVENTORY = yaml.safe_load(f)
+    INVENTORY = yaml.load(f, Loader=SafeLoader)
 
 SITES = INVENTORY.get("sites", [])
 
+def index_sites(sites):
+    """
+    Build name -> site dict and attach per-site access switch lookup dicts.
+    Hosts and names are lowercased once here so CDP neighbor matching needs no per-request .lower().
+    """
+    for s in sites:
+        access = s.get("access_switches", [])
+        s["_access_by_name"] = {sw["name"]: sw for sw in access}
+        s["_name_lc_to_sw"] = {sw["name"].lower(): sw for sw in access}
+        s["_host_lc_to_sw"] = {}
+        for sw in access:
+            # "ip" is accepted instead of "host", see sanitize_device_for_netmiko
+            host = sw.get("host") or sw.get("ip")
+            if host:
+                s["_host_lc_to_sw"][host.lower()] = sw
+    return {s["name"]: s for s in sites}
+
+SITES_BY_NAME = index_sites(SITES)
+
 # Helper lookups
 def get_site_by_name(site_name):
-    for s in SITES:
-        if s.get("name") == site_name:
-            return s
-    return None
+    return SITES_BY_NAME.get(site_name)
 
-def find_access_by_name(site_name, name):
-    site = get_site_by_name(site_name)
+def find_access_by_name(site, name):
     if not site:
         return None
-    for sw in site.get("access_switches", []):
-        if sw.get("name") == name:
-            sw_copy = sw.copy()
-            sw_copy["_site"] = {"name": site.get("name"), "description": site.get("description")}
-            return sw_copy
-    return None
+    sw = site["_access_by_name"].get(name)
+    if not sw:
+        return None
+    sw_copy = sw.copy()
+    sw_copy["_site"] = {"name": site.get("name"), "description": site.get("description")}
+    return sw_copy
+
+def map_neighbor_to_access(site, neighbor):
+    """Map a CDP neighbor to an inventory access switch by IP, then by name/host."""
+    cdp_ip = (neighbor.get("cdp_ip") or "").lower()
+    cdp_name = (neighbor.get("cdp_name") or "").lower()
+    # CDP may report the hostname, or the name an access switch is reachable by
+    return (
+        site["_host_lc_to_sw"].get(cdp_ip)
+        or site["_name_lc_to_sw"].get(cdp_name)
+        or site["_host_lc_to_sw"].get(cdp_name)
+    )
 
 # Caches
-tdr_cache = TTLCache(maxsize=2048, ttl=TDR_CACHE_TTL)
-mac_cache = TTLCache(maxsize=2048, ttl=60)
-interfaces_cache = TTLCache(maxsize=1024, ttl=INTERFACES_CACHE_TTL)
+redis_client = None
+if CACHE_BACKEND == "redis":
+    import redis  # uses the hiredis parser if installed
+    redis_client = redis.Redis.from_url(REDIS_URL)
+
+def redis_key(*parts):
+    """Flatten a cache key tuple into a Redis key string."""
+    return ":".join(str(p) for p in parts)
+
+class RedisCache:
+    """Minimal diskcache-like get/set on top of Redis, values are pickled."""
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def get(self, key):
+        value = self.client.get(redis_key("webcablediag", self.name, *key))
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, expire):
+        self.client.setex(redis_key("webcablediag", self.name, *key), expire, pickle.dumps(value))
+
+    def add(self, key, value, expire):
+        return bool(self.client.set(redis_key("webcablediag", self.name, *key), pickle.dumps(value), nx=True, ex=expire))
+
+def make_cache(name, maxsize, ttl):
+    """Create a cache for the configured backend. Access it through cget/cset only."""
+    if CACHE_BACKEND == "redis":
+        return RedisCache(redis_client, name)
+    if CACHE_BACKEND == "disk":
+        from diskcache import Cache
+        return Cache(os.path.join(CACHE_DIR, name), size_limit=CACHE_SIZE_LIMIT)
+    return TTLCache(maxsize=maxsize, ttl=ttl)
+
+def cget(c, key):
+    """Return the cached value for key or None."""
+    return c.get(key)
+
+def cset(c, key, value, ttl):
+    if isinstance(c, TTLCache):
+        c[key] = value  # TTLCache uses its own ttl
+    else:
+        c.set(key, value, expire=ttl)
+
+def cadd(c, key, value, ttl):
+    """Store value only if key is not cached yet. Returns True if it was stored."""
+    if isinstance(c, TTLCache):
+        if key in c:
+            return False
+        c[key] = value
+        return True
+    return c.add(key, value, expire=ttl)
+
+tdr_cache = make_cache("tdr", maxsize=2048, ttl=TDR_CACHE_TTL)
+mac_cache = make_cache("mac", maxsize=2048, ttl=MAC_CACHE_TTL)
+interfaces_cache = make_cache("interfaces", maxsize=1024, ttl=INTERFACES_CACHE_TTL)
 
 executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
 # --- SSH helpers --------------------------------------------------------------
-def ssh_connect(device):
-    """Create a ConnectHandler with a sanitized copy of device params."""
+def netmiko_params(device):
+    """Merge global netmiko defaults into device and sanitize the result."""
     defaults = INVENTORY.get("netmiko_defaults", {})
     device = {**defaults, **device}
-    params = sanitize_device_for_netmiko(device)
-    return ConnectHandler(**params)
+    return sanitize_device_for_netmiko(device)
+
+class PooledConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+class ConnectionPool:
+    """
+    Thread-safe pool of idle Netmiko sessions keyed by (host, port, username, device_type).
+    Sessions are health-checked when handed back and evicted in the background
+    once they have been idle or alive for too long. Sessions per switch are capped,
+    both idle and in use, so the switch's VTY lines are not used up.
+    """
+    def __init__(self, max_size, idle_timeout, max_age, max_idle_per_host, max_active_per_host, sweep_interval=60):
+        self.max_size = max_size
+        self.max_idle_per_host = max_idle_per_host
+        self.max_active_per_host = max_active_per_host
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._idle = {}  # key -> list of PooledConnection
+        self._active = {}  # key -> BoundedSemaphore limiting open sessions
+        self._size = 0
+        self._timer = None
+
+    @staticmethod
+    def _key(params):
+        return (params.get("host"), params.get("port", 22), params.get("username"), params.get("device_type"))
+
+    def _expired(self, entry, now):
+        return now - entry.last_used > self.idle_timeout or now - entry.created_at > self.max_age
+
+    def _checkout(self, key):
+        """Pop the most recently used idle session for key, discarding expired ones."""
+        stale = []
+        entry = None
+        now = time.monotonic()
+        with self._lock:
+            entries = self._idle.get(key, [])
+            while entries:
+                candidate = entries.pop()
+                self._size -= 1
+                if self._expired(candidate, now):
+                    stale.append(candidate)
+                    continue
+                entry = candidate
+                break
+            if not entries:
+                self._idle.pop(key, None)
+        for s in stale:
+            self._close(s)
+        return entry
+
+    def _checkin(self, key, entry):
+        try:
+            entry.conn.find_prompt()
+        except Exception as e:
+            logger.debug("Discarding unhealthy SSH session to %s: %s", key[0], e)
+            self._close(entry)
+            return
+        entry.last_used = time.monotonic()
+        with self._lock:
+            entries = self._idle.setdefault(key, [])
+            if self._size < self.max_size and len(entries) < self.max_idle_per_host:
+                entries.append(entry)
+                self._size += 1
+                self._schedule_sweep()
+                return
+        self._close(entry)
+
+    @staticmethod
+    def _close(entry):
+        try:
+            entry.conn.disconnect()
+        except Exception as e:
+            logger.debug("Error while disconnecting SSH session: %s", e)
+
+    def _slots(self, key):
+        with self._lock:
+            sem = self._active.get(key)
+            if sem is None:
+                sem = self._active[key] = threading.BoundedSemaphore(self.max_active_per_host)
+            return sem
+
+    @contextmanager
+    def acquire(self, device, keep=True):
+        """
+        Yield a connected ConnectHandler for device, reusing an idle session if possible.
+        Blocks while max_active_per_host sessions to the switch are in use.
+        With keep=False the session is closed afterwards instead of returned to the pool.
+        """
+        params = netmiko_params(device)
+        key = self._key(params)
+        slots = self._slots(key)
+        slots.acquire()
+        try:
+            entry = self._checkout(key)
+            if entry is None:
+                entry = PooledConnection(ConnectHandler(**params))
+            try:
+                yield entry.conn
+            except BaseException:
+                # session state is unknown after a failure or an abandoned generator, do not hand it out again
+                self._close(entry)
+                raise
+            if keep:
+                self._checkin(key, entry)
+            else:
+                self._close(entry)
+        finally:
+            slots.release()
+
+    def _schedule_sweep(self):
+        # must be called with self._lock held
+        if self._timer is None:
+            self._timer = threading.Timer(self.sweep_interval, self._sweep)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _sweep(self):
+        stale = []
+        now = time.monotonic()
+        with self._lock:
+            self._timer = None
+            for key in list(self._idle):
+                keep = []
+                for entry in self._idle[key]:
+                    (stale if self._expired(entry, now) else keep).append(entry)
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+            self._size -= len(stale)
+            if self._size:
+                self._schedule_sweep()
+        for entry in stale:
+            self._close(entry)
+
+pool = ConnectionPool(
+    max_size=CONNECTION_POOL_MAX_SIZE,
+    idle_timeout=CONNECTION_POOL_IDLE_TIMEOUT,
+    max_age=CONNECTION_POOL_MAX_AGE,
+    max_idle_per_host=CONNECTION_POOL_MAX_IDLE_PER_HOST,
+    max_active_per_host=CONNECTION_POOL_MAX_ACTIVE_PER_HOST,
+)
+
+class SingleFlight:
+    """
+    Collapse concurrent calls for the same key into one execution.
+    The first caller (leader) computes the value in its own thread, later callers wait for it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> Future
+
+    def claim(self, key):
+        """
+        Claim key. Returns (future, leader). The leader must compute the value and
+        pass it to finish(), everyone else waits on future.
+        """
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                return fut, False
+            fut = Future()
+            self._inflight[key] = fut
+            return fut, True
+
+    def finish(self, key, fut, value=None, exc=None):
+        """Publish the leader's value (or exception) to the waiters and release key."""
+        with self._lock:
+            self._inflight.pop(key, None)
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(value)
+
+    def lock_elsewhere(self, key):
+        """Lock a claimed key against other processes. Returns False if one of them holds it."""
+        return True
+
+    def wait_elsewhere(self, key, cache):
+        """Wait for the process holding key and return its result from cache, or None."""
+        return None
+
+    def do(self, key, fn, *args, cache=None, **kwargs):
+        """Run fn(*args, **kwargs) once per key; cache is where fn stores its result."""
+        fut, leader = self.claim(key)
+        if not leader:
+            return fut.result()
+        try:
+            value = None
+            if not self.lock_elsewhere(key):
+                value = self.wait_elsewhere(key, cache)
+            if value is None:
+                # nobody else ran it, or they failed / did not cache anything
+                value = fn(*args, **kwargs)
+        except BaseException as e:
+            self.finish(key, fut, exc=e)
+            raise
+        self.finish(key, fut, value)
+        return value
+
+# delete the lock only if it still holds our token, it may have expired and been taken over
+_REDIS_RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# same check before extending the lock's expiry (ARGV[2] in milliseconds)
+_REDIS_EXTEND_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+class RedisSingleFlight(SingleFlight):
+    """
+    SingleFlight that also deduplicates across worker processes and hosts.
+    A Redis SET NX lock elects one runner, the others wait for its result in cache.
+    Held locks are extended in the background, so they only expire if their holder dies.
+    """
+    def __init__(self, client, lock_ttl):
+        super().__init__()
+        self.client = client
+        self.lock_ttl = lock_ttl
+        self._tokens = {}  # key -> token of the Redis lock this process holds
+        self._keepalive = None
+        self._release_lock = client.register_script(_REDIS_RELEASE_LOCK)
+        self._extend_lock = client.register_script(_REDIS_EXTEND_LOCK)
+
+    @staticmethod
+    def _lock_key(key):
+        return redis_key("webcablediag", "lock", *key)
+
+    def lock_elsewhere(self, key):
+        token = uuid.uuid4().hex
+        if not self.client.set(self._lock_key(key), token, nx=True, ex=self.lock_ttl):
+            return False
+        with self._lock:
+            self._tokens[key] = token
+            if self._keepalive is None:
+                self._keepalive = threading.Thread(target=self._keepalive_loop, name="singleflight-keepalive", daemon=True)
+                self._keepalive.start()
+        return True
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(self.lock_ttl / 3)
+            with self._lock:
+                held = list(self._tokens.items())
+                if not held:
+                    self._keepalive = None
+                    return
+            for key, token in held:
+                try:
+                    if not self._extend_lock(keys=[self._lock_key(key)], args=[token, int(self.lock_ttl * 1000)]):
+                        logger.warning("Lost Redis lock for %s", key)
+                except Exception as e:
+                    logger.warning("Extending Redis lock for %s failed: %s", key, e)
+
+    def wait_elsewhere(self, key, cache):
+        # the holder keeps the lock alive while it works, so wait as long as it exists
+        while True:
+            time.sleep(1)
+            if cache is not None:
+                value = cget(cache, key)
+                if value is not None:
+                    return value
+            if not self.client.exists(self._lock_key(key)):
+                return None
+
+    def finish(self, key, fut, value=None, exc=None):
+        with self._lock:
+            token = self._tokens.pop(key, None)
+        if token is not None:
+            try:
+                self._release_lock(keys=[self._lock_key(key)], args=[token])
+            except Exception as e:
+                logger.warning("Releasing Redis lock for %s failed: %s", key, e)
+        super().finish(key, fut, value, exc)
+
+if redis_client is not None:
+    singleflight = RedisSingleFlight(redis_client, SINGLEFLIGHT_LOCK_TTL)
+else:
+    singleflight = SingleFlight()
 
 def cache_key(prefix, *parts):
-    return prefix + ":" + "|".join(parts)
+    return (prefix,) + parts
 
 def normalize_mac(mac):
-    s = re.sub(r"[^0-9a-fA-F]", "", mac).lower()
+    return _normalize_mac(str(mac))
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_mac(mac):
+    s = _MAC_STRIP_RE.sub("", mac).lower()
     if len(s) != 12:
         raise ValueError("Ungültige MAC Adresse")
     return s[0:4] + "." + s[4:8] + "." + s[8:12]
 
 # --- Interfaces retrieval and parsing ----------------------------------------
+class Interface(NamedTuple):
+    name: Optional[str]
+    description: Optional[str]
+    status: Optional[str]
+    type: Optional[str]
+
+class TdrPair(NamedTuple):
+    pair: Optional[str]
+    status: Optional[str]
+    length_m: Optional[str]
+    details: str
+
 def get_interfaces_for_device(device):
     """
-    Returns a list of interface dicts: {name, status, type}
+    Returns a list of Interface tuples: (name, description, status, type)
     Uses caching to avoid frequent SSH calls.
     """
     logger.info(f"Fetching interfaces for device {device.get('host')}")
     key = cache_key("iflist", device.get("host"))
-    if key in interfaces_cache:
-        return interfaces_cache[key]
+    cached = cget(interfaces_cache, key)
+    if cached is not None:
+        return cached
+    return singleflight.do(key, _get_interfaces_uncached, device, key, cache=interfaces_cache)
 
-    conn = ssh_connect(device)
-    try:
+def _get_interfaces_uncached(device, key, keep_session=True):
+    with pool.acquire(device, keep=keep_session) as conn:
         out = conn.send_command("show interfaces status", delay_factor=1, use_textfsm=True)  # show int desc?
-        logger.debug(f"Interface status output: {out}")
-        # interfaces: list of {"name", "description", "status", "type"}
-        interfaces = [
-            {
-                "name": entry.get("port"),
-                "description": entry.get("name"),
-                "status": entry.get("status"),
-                "type": entry.get("type")
-            }
-            for entry in out
+    logger.debug("Interface status output: %s", out)
+    interfaces = [
+        Interface(
+            name=entry.get("port"),
+            description=entry.get("name"),
+            status=entry.get("status"),
+            type=entry.get("type"),
+        )
+        for entry in out
+    ]
+    # only store in cache if not empty as empty is probably an error
+    if interfaces and interfaces != []:
+        cset(interfaces_cache, key, interfaces, INTERFACES_CACHE_TTL)
+    return interfaces
+
+def refresh_interfaces_for_device(device):
+    """
+    Fetch the interface list of device bypassing the cache and store it in the cache.
+    The SSH session is closed afterwards, periodic refreshes must not keep pooled
+    sessions from ever idling out.
+    """
+    key = cache_key("iflist", device.get("host"))
+    return singleflight.do(key, _get_interfaces_uncached, device, key, keep_session=False, cache=interfaces_cache)
+
+PREFETCH_INTERVAL = max(INTERFACES_CACHE_TTL - 5, 1)
+
+def _prefetch_one(device):
+    # With a shared cache backend every worker prefetches, but only the first one
+    # to claim a switch in a round refreshes it. With the memory backend each worker
+    # has its own cache and has to fetch everything itself.
+    if CACHE_BACKEND != "memory":
+        if not cadd(interfaces_cache, cache_key("prefetch", device.get("host")), True, max(PREFETCH_INTERVAL - 1, 1)):
+            return
+    try:
+        refresh_interfaces_for_device(device)
+    except Exception as e:
+        logger.warning(f"Prefetching interfaces for {device.get('host')} failed: {e}")
+
+def _prefetch_loop():
+    while True:
+        started = time.monotonic()
+        futures = [
+            executor.submit(_prefetch_one, sw)
+            for site in SITES
+            for sw in site.get("access_switches", [])
         ]
-        # only store in cache if not empty as empty is probably an error
-        if interfaces and interfaces != []:
-            interfaces_cache[key] = interfaces
-        return interfaces
-    finally:
-        conn.disconnect()
+        # never start a new round before the previous one is done
+        wait(futures)
+        time.sleep(max(PREFETCH_INTERVAL - (time.monotonic() - started), 1))
 
-def find_mac_on_central_for_site(site_name, mac):
-    logger.info(f"Searching for MAC {mac} on central switch for site: {site_name}")
-    key = cache_key("mac", site_name, mac)
-    if key in mac_cache:
-        return mac_cache[key]
-    site = get_site_by_name(site_name)
+def prefetch_interfaces():
+    """
+    Refresh the interface lists of all access switches in the background, one round
+    shortly before the previous round's entries expire, so switch pages never see a cold cache.
+    """
+    thread = threading.Thread(target=_prefetch_loop, name="prefetch-interfaces", daemon=True)
+    thread.start()
+
+def lookup_mac_interface(device, m_formatted):
+    """
+    Look up the interface a (normalized) MAC is learned on.
+    Returns (interface, raw) where raw is the TextFSM-parsed list or, if the
+    template could not parse the output, the raw command output.
+    """
+    cmd = f"show mac address-table address {m_formatted}"
+    with pool.acquire(device) as conn:
+        out = conn.send_command(cmd, use_textfsm=True)
+    logger.debug("MAC search output: %s", out)
+    interface = None
+    if isinstance(out, list):
+        if out:
+            # field names differ between platform templates
+            port = out[0].get("destination_port") or out[0].get("ports")
+            if isinstance(port, list):
+                port = port[0] if port else None
+            interface = port or None
+        return interface, out
+
+    # TextFSM could not parse the output, fall back to scanning the lines
+    for line in out.splitlines():
+        if m_formatted in line:
+            parts = line.split()
+            for token in reversed(parts):
+                if maybe_iface_token(token) and _IFACE_TOKEN_RE.match(token):
+                    interface = token
+                    break
+            if interface:
+                break
+    return interface, out
+
+def find_mac_on_central_for_site(site, mac):
     if not site:
         raise ValueError("Site nicht gefunden")
+    site_name = site.get("name")
+    logger.info(f"Searching for MAC {mac} on central switch for site: {site_name}")
+    key = cache_key("mac", site_name, mac)
+    cached = cget(mac_cache, key)
+    if cached is not None:
+        return cached
     central = site.get("central_switch")
     m_formatted = normalize_mac(mac)
-    conn = ssh_connect(central)
-    try:
-        cmd = f"show mac address-table address {m_formatted}"
-        out = conn.send_command(cmd)  # may use textfsm
-        logger.debug(f"MAC search output: {out}")
-        interface = None
-        for line in out.splitlines():
-            if m_formatted in line:
-                parts = line.split()
-                for token in reversed(parts):
-                    if re.match(r"^(Gi|Fa|Te|Tw|Et|Ethernet|Po|Port-channel|Eth)\S*", token, re.IGNORECASE) or re.match(r"^[A-Za-z]+[0-9/]+$", token):
-                        interface = token
-                        break
-                if interface:
-                    break
-        result = {"mac": m_formatted, "raw": out, "interface": interface, "site": site_name}
-        mac_cache[key] = result
-        return result
-    finally:
-        conn.disconnect()
+    return singleflight.do(key, _find_mac_on_central_uncached, site_name, central, m_formatted, key, cache=mac_cache)
 
-def resolve_access_switch_from_interface_for_site(site_name, interface):
+def _find_mac_on_central_uncached(site_name, central, m_formatted, key):
+    interface, out = lookup_mac_interface(central, m_formatted)
+    result = {"mac": m_formatted, "raw": out, "interface": interface, "site": site_name}
+    cset(mac_cache, key, result, MAC_CACHE_TTL)
+    return result
+
+def resolve_access_switch_from_interface_for_site(site, interface):
+    site_name = site.get("name")
     logger.info(f"Resolving access switch from interface {interface} for site: {site_name}")
-    site = get_site_by_name(site_name)
     central = site.get("central_switch")
-    conn = ssh_connect(central)
-    try:
-        cmd = f"show cdp neighbors {interface} detail"  # TODO nexus support
-        if "nxos" in central.get("device_type", ""):
-            cmd = f"show cdp neighbors interface {interface} detail"
+    cmd = f"show cdp neighbors {interface} detail"  # TODO nexus support
+    if "nxos" in central.get("device_type", ""):
+        cmd = f"show cdp neighbors interface {interface} detail"
+    with pool.acquire(central) as conn:
         out = conn.send_command(cmd)  # may use textfsm
-        logger.debug(f"CDP neighbor output: {out}")
-        name = None
-        ip = None
-        for line in out.splitlines():
-            line = line.strip()
-            if line.startswith("Device ID:"):
-                name = line.split("Device ID:")[1].strip()
-            if "IP address:" in line:
-                ip = line.split("IP address:")[1].strip()
-        return {"cdp_name": name, "cdp_ip": ip, "raw": out, "site": site_name}
-    finally:
-        conn.disconnect()
+    logger.debug("CDP neighbor output: %s", out)
+    name = None
+    ip = None
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith("Device ID:"):
+            name = line.split("Device ID:")[1].strip()
+        if "IP address:" in line:
+            ip = line.split("IP address:")[1].strip()
+    return {"cdp_name": name, "cdp_ip": ip, "raw": out, "site": site_name}
+
+def scan_length_status(text):
+    """Return the first (length, status) found in text with a single regex scan."""
+    length = None
+    status = None
+    for m in _LEN_STATUS_RE.finditer(text):
+        if m.group("len") is not None:
+            if length is None:
+                length = m.group("len")
+        elif status is None:
+            status = m.group("status").lower()
+        if length is not None and status is not None:
+            break
+    return length, status
 
 def parse_tdr_output(out):
     parsed = {"raw": out, "pairs": []}
-    lines = [l.strip() for l in out.splitlines() if l.strip()]
-    pair_re = re.compile(r".{0,25}Pair\s+([A-D])[:\-\s]*(.*)", re.IGNORECASE)
-    len_re = re.compile(r"(\d+(\.\d+)?)(\s*\+\/\-\s*\d*)?\s*(m|meters|meter|m\.)", re.IGNORECASE)
-    status_re = re.compile(r"(open|short|ok|normal|fault|not supported|unsupported|no tdr)", re.IGNORECASE)
-    for line in lines:
-        m = pair_re.match(line)
+    pair_matches = []
+    fallback_matches = []
+    for line in out.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        m = _PAIR_RE.match(line)
         if m:
-            pair = m.group(1).upper()
             rest = m.group(2).strip()
-            length = None
-            status = None
-            lm = len_re.search(rest)
-            if lm:
-                length = lm.group(1)
-            sm = status_re.search(rest)
-            if sm:
-                status = sm.group(1).lower()
-            parsed["pairs"].append({
-                "pair": pair,
-                "status": status,
-                "length_m": length,
-                "details": rest
-            })
-    if not parsed["pairs"]:
-        for line in lines:
-            lm = len_re.search(line)
-            if lm:
-                length = lm.group(1)
-                parsed["pairs"].append({
-                    "pair": None,
-                    "status": None,
-                    "length_m": length,
-                    "details": line
-                })
+            length, status = scan_length_status(rest)
+            pair_matches.append(TdrPair(
+                pair=m.group(1).upper(),
+                status=status,
+                length_m=length,
+                details=rest,
+            ))
+        elif not pair_matches:
+            # only needed if no line carries pair data
+            length, _ = scan_length_status(line)
+            if length is not None:
+                fallback_matches.append(TdrPair(
+                    pair=None,
+                    status=None,
+                    length_m=length,
+                    details=line,
+                ))
+    parsed["pairs"] = pair_matches or fallback_matches
     if not parsed["pairs"]:
         parsed["note"] = "No parsed pair data; raw output provided"
     return parsed
 
-def tdr_single_interface(device, interface):
+def tdr_result_as_json(res):
+    """Return a JSON-serializable copy of a TDR result, pairs as objects instead of arrays."""
+    if "pairs" not in res:
+        return res
+    return {**res, "pairs": [p._asdict() for p in res["pairs"]]}
+
+def tdr_result_ready(out):
     """
-    Run TDR diagnostics on a single interface and fetch the results after a delay.
+    A result counts as finished only if it shows results ("last run on" or a pair line)
+    and nothing is pending, so e.g. a "never issued" message right after the start keeps polling.
     """
-    logger.info(f"Running TDR diagnostics on device {device.get('host')} for interface {interface}")
-    key = cache_key("tdr", device.get("host"), interface)
-    if key in tdr_cache:
-        return tdr_cache[key]
-    
-    conn = ssh_connect(device)
-    try:
+    return bool(out) and not _TDR_PENDING_RE.search(out) and bool(_TDR_DONE_RE.search(out))
+
+def poll_tdr_result(conn, interface, deadline):
+    """
+    Poll the TDR result of interface with TDR_POLL_DELAYS backoff until the test has
+    finished or the monotonic deadline has passed. Returns the last output ("" if none).
+    """
+    out = ""
+    for delay in TDR_POLL_DELAYS:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+        out = conn.send_command(f"show cable-diagnostics tdr interface {interface}")
+        if tdr_result_ready(out):
+            break
+    return out
+
+def iter_tdr_batch_on_switch(device, interfaces):
+    """
+    Run TDR diagnostics on several interfaces of one switch over a single SSH session,
+    yielding (interface, parsed result) as they are collected. All tests are started
+    back-to-back, then results are fetched once the last one has finished.
+    """
+    logger.info(f"Running batched TDR diagnostics on device {device.get('host')} for interfaces {interfaces}")
+    with pool.acquire(device) as conn:
         conn.send_command("terminal length 0")
-        # Start TDR diagnostics
-        start_output = conn.send_command(
-            f"test cable-diagnostics tdr interface {interface}",
-            expect_string=r"#|>", delay_factor=1
-        )
-        logger.debug(f"TDR start output: {start_output}")
-        if "Invalid input" in start_output or "Unknown command" in start_output or "Command not found" in start_output:
-            parsed = {"raw": start_output, "error": "No valid TDR command on device"}
-            tdr_cache[key] = parsed
-            return parsed
-        
-        # Wait for TDR results to be ready
-        time.sleep(10)  # Adjust delay as needed based on device behavior
-        
-        # Fetch TDR results
-        result_output = conn.send_command(f"show cable-diagnostics tdr interface {interface}")
-        logger.debug(f"TDR result output: {result_output}")
-        parsed = parse_tdr_output(result_output)
-        tdr_cache[key] = parsed
-        return parsed
+        started = []
+        for iface in interfaces:
+            start_output = conn.send_command(
+                f"test cable-diagnostics tdr interface {iface}",
+                expect_string=r"#|>", delay_factor=1
+            )
+            logger.debug("TDR start output for %s: %s", iface, start_output)
+            if "Invalid input" in start_output or "Unknown command" in start_output or "Command not found" in start_output:
+                parsed = {"raw": start_output, "error": "No valid TDR command on device"}
+                cset(tdr_cache, cache_key("tdr", device.get("host"), iface), parsed, TDR_CACHE_TTL)
+                yield iface, parsed
+            else:
+                started.append(iface)
+
+        # one polling budget for the whole batch, so hung tests cannot add up
+        deadline = time.monotonic() + sum(TDR_POLL_DELAYS)
+        last = started[-1] if started else None
+        last_output = poll_tdr_result(conn, last, deadline) if started else ""
+
+        for iface in started:
+            if iface == last:
+                # Tests run in start order, so the last one started is the last to finish
+                result_output = last_output
+            else:
+                result_output = conn.send_command(f"show cable-diagnostics tdr interface {iface}")
+                if not tdr_result_ready(result_output):
+                    result_output = poll_tdr_result(conn, iface, deadline) or result_output
+            logger.debug("TDR result output for %s: %s", iface, result_output)
+            parsed = parse_tdr_output(result_output)
+            cset(tdr_cache, cache_key("tdr", device.get("host"), iface), parsed, TDR_CACHE_TTL)
+            yield iface, parsed
+
+def iter_tdr_on_switch(device, interfaces):
+    """
+    Yield (interface, result) for the given interfaces of a switch: cached results first,
+    then the ones this call runs as one batch on the switch, then those another caller
+    was already running. Concurrent callers never test the same interface twice.
+    """
+    host = device.get("host")
+    claims = {}  # iface -> (key, future) this call has to finish
+    elsewhere = []  # claimed here, but another process is already testing them
+    waiting = {}  # iface -> future of another caller in this process
+    try:
+        for iface in dict.fromkeys(interfaces):
+            key = cache_key("tdr", host, iface)
+            cached = cget(tdr_cache, key)
+            if cached is not None:
+                yield iface, cached
+                continue
+            fut, leader = singleflight.claim(key)
+            if not leader:
+                waiting[iface] = fut
+                continue
+            claims[iface] = (key, fut)
+            if not singleflight.lock_elsewhere(key):
+                elsewhere.append(iface)
+
+        yield from _run_tdr_claims(device, [i for i in claims if i not in elsewhere], claims)
+
+        retry = []
+        for iface in elsewhere:
+            key, fut = claims[iface]
+            res = singleflight.wait_elsewhere(key, tdr_cache)
+            if res is None:
+                # the other process failed or gave up, test it here
+                retry.append(iface)
+                continue
+            del claims[iface]
+            singleflight.finish(key, fut, res)
+            yield iface, res
+        yield from _run_tdr_claims(device, retry, claims)
+
+        for iface, fut in waiting.items():
+            try:
+                res = fut.result()
+            except Exception as e:
+                res = {"raw": "", "error": str(e)}
+            yield iface, res
     finally:
-        conn.disconnect()
-
-def tdr_on_switch_async(device, interfaces):
-    """TODO rework this AI shit"""
-    futures = {executor.submit(tdr_single_interface, device, iface): iface for iface in interfaces}
-    results = {}
-    for fut in as_completed(futures):
-        iface = futures[fut]
-        try:
-            res = fut.result()
-        except Exception as e:
-            res = {"raw": "", "error": str(e)}
-        results[iface] = res
-    return results
+        # release what is left, e.g. when the client went away mid-stream
+        for key, fut in claims.values():
+            singleflight.finish(key, fut, exc=RuntimeError("TDR abgebrochen"))
+
+def _run_tdr_claims(device, interfaces, claims):
+    """Run one TDR batch for interfaces and finish their claims as results come in."""
+    if not interfaces:
+        return
+    try:
+        for iface, res in iter_tdr_batch_on_switch(device, interfaces):
+            key, fut = claims.pop(iface)
+            singleflight.finish(key, fut, res)
+            yield iface, res
+    except Exception as e:
+        for iface in interfaces:
+            if iface in claims:
+                res = {"raw": "", "error": str(e)}
+                key, fut = claims.pop(iface)
+                singleflight.finish(key, fut, res)
+                yield iface, res
+
+if PREFETCH_ON_STARTUP:
+    prefetch_interfaces()
 
 # --- Flask routes -------------------------------------------------------------
+class MacConverter(BaseConverter):
+    """URL converter that only matches valid MACs and hands them to the view normalized."""
+    regex = r"[0-9A-Fa-f:\.\-]{12,17}"
+
+    def to_python(self, value):
+        try:
+            return normalize_mac(value)
+        except ValueError:
+            raise ValidationError()
+
+app.url_map.converters["mac"] = MacConverter
+
 @app.route("/", methods=["GET"])
 def index():
     return render_template("index.html", sites=SITES)
@@ -275,7 +869,12 @@ def site_page(site_name):
             sw_name = request.form.get("access_switch")
             return redirect(url_for("switch_detail", site_name=site_name, name=sw_name))
         if "search_mac" in request.form:
-            mac = request.form.get("mac")
+            mac = request.form.get("mac", "")
+            try:
+                mac = normalize_mac(mac)
+            except ValueError:
+                flash("Ungültige MAC Adresse")
+                return redirect(url_for("site_page", site_name=site_name))
             return redirect(url_for("search_mac_sitewide", site_name=site_name, mac=mac))
     return render_template("site.html", site=site, access_list=access_list, central=central)
 
@@ -285,7 +884,7 @@ def switch_detail(site_name, name):
     if not site:
         flash("Site nicht gefunden")
         return redirect(url_for("index"))
-    device = find_access_by_name(site_name, name)
+    device = find_access_by_name(site, name)
     if not device:
         flash("Switch nicht im Inventar für diese Site")
         return redirect(url_for("site_page", site_name=site_name))
@@ -293,7 +892,12 @@ def switch_detail(site_name, name):
     if request.method == "POST":
         # MAC address search
         if "search_mac" in request.form:
-            mac = request.form.get("mac")
+            mac = request.form.get("mac", "")
+            try:
+                mac = normalize_mac(mac)
+            except ValueError:
+                flash("Ungültige MAC Adresse")
+                return redirect(url_for("switch_detail", site_name=site_name, name=name))
             return redirect(url_for("search_mac_switch", site_name=site_name, switch_name=name, mac=mac))
         
         if "run_tdr" in request.form:
@@ -308,78 +912,68 @@ def switch_detail(site_name, name):
             if not chosen:
                 flash("Keine Schnittstellen ausgewählt")
                 return redirect(url_for("switch_detail", site_name=site_name, name=name))
-            results = tdr_on_switch_async(device, chosen)
-            return render_template("results.html", device=device, results=results, site=site)
+            # results are streamed by the page from run_tdr_stream
+            chosen = list(dict.fromkeys(chosen))
+            return render_template("results.html", device=device, ifaces=chosen, site=site)
 
-    # GET: fetch interface list (cached)
+    # GET: interfaces are loaded by the page from switch_interfaces_json
+    return render_template("switch.html", device=device, site=site, highlighted_ifaces=request.args.get("highlighted_ifaces", "").split(","))
+
+@app.route("/site/<site_name>/switch/<name>/interfaces.json", methods=["GET"])
+def switch_interfaces_json(site_name, name):
+    device = find_access_by_name(get_site_by_name(site_name), name)
+    if not device:
+        return jsonify({"error": "Switch nicht im Inventar für diese Site"}), 404
     try:
         interfaces = get_interfaces_for_device(device)
     except Exception as e:
-        interfaces = []
-        flash(f"Fehler beim Abrufen der Interfaces: {e}")
-    
-    # show cached TDR results of this switch if available
-    cached_results = [
-        {
-            "interface": iface.get("name"),
-            "tdr": tdr_cache[cache_key("tdr", device.get("host"), iface.get("name"))]
-        }
-        for iface in interfaces
-        if cache_key("tdr", device.get("host"), iface.get("name")) in tdr_cache
-    ]
+        logger.warning(f"Fetching interfaces for {device.get('host')} failed: {e}")
+        return jsonify({"error": f"Fehler beim Abrufen der Interfaces: {e}"}), 502
+    return jsonify([iface._asdict() for iface in interfaces])
 
-    return render_template("switch.html", device=device, site=site, interfaces=interfaces, highlighted_ifaces=request.args.get("highlighted_ifaces", "").split(","))
+@app.route("/site/<site_name>/switch/<name>/run_tdr_stream", methods=["GET"])
+def run_tdr_stream(site_name, name):
+    """Server-Sent Events stream with one event per interface as its TDR result arrives."""
+    device = find_access_by_name(get_site_by_name(site_name), name)
+    if not device:
+        return jsonify({"error": "Switch nicht im Inventar für diese Site"}), 404
+    chosen = list(dict.fromkeys(s.strip() for s in request.args.get("ifaces", "").split(",") if s.strip()))
+
+    def gen():
+        for iface, res in iter_tdr_on_switch(device, chosen):
+            yield f"data: {json.dumps({'iface': iface, 'tdr': tdr_result_as_json(res)})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(stream_with_context(gen()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
-@app.route("/site/<site_name>/search_mac/<mac>", methods=["GET"])
+@app.route("/site/<site_name>/search_mac/<mac:mac>", methods=["GET"])
 def search_mac_sitewide(site_name, mac):
+    site = get_site_by_name(site_name)
     try:
-        mac_result = find_mac_on_central_for_site(site_name, mac)
+        mac_result = find_mac_on_central_for_site(site, mac)
     except ValueError as ve:
         flash("Ungültige MAC Adresse oder Site nicht vorhanden")
-        print(ve)
+        logger.warning(f"MAC search on site {site_name} failed: {ve}")
         return redirect(url_for("site_page", site_name=site_name))
     interface = mac_result.get("interface")
     if not interface:
         flash("MAC nicht in MAC‑Tabelle des zentralen Switches gefunden")
         return redirect(url_for("site_page", site_name=site_name))
-    neighbor = resolve_access_switch_from_interface_for_site(site_name, interface)
-    mapped = None
-    for sw in get_site_by_name(site_name).get("access_switches", []):
-        if neighbor.get("cdp_ip") and sw.get("host") == neighbor.get("cdp_ip"):
-            mapped = sw
-            break
-        if neighbor.get("cdp_name") and (sw.get("name").lower() == neighbor.get("cdp_name").lower() or sw.get("host").lower() == neighbor.get("cdp_name").lower()):
-            mapped = sw
-            break
-    return render_template("mac_result.html", mac_search=mac_result, neighbor=neighbor, mapped=mapped, site=get_site_by_name(site_name))
+    neighbor = resolve_access_switch_from_interface_for_site(site, interface)
+    mapped = map_neighbor_to_access(site, neighbor)
+    return render_template("mac_result.html", mac_search=mac_result, neighbor=neighbor, mapped=mapped, site=site)
 
-@app.route("/site/<site_name>/switch/<switch_name>/search_mac/<mac>", methods=["GET"])
+@app.route("/site/<site_name>/switch/<switch_name>/search_mac/<mac:mac>", methods=["GET"])
 def search_mac_switch(site_name, switch_name, mac):
     logger.info(f"Searching MAC {mac} on switch: {switch_name} in site: {site_name}")
-    device = find_access_by_name(site_name, switch_name)
+    device = find_access_by_name(get_site_by_name(site_name), switch_name)
     if not device:
         flash("Switch nicht im Inventar für diese Site")
         return redirect(url_for("site_page", site_name=site_name))
     
     m_formatted = normalize_mac(mac)
-    conn = ssh_connect(device)
-    try:
-        cmd = f"show mac address-table address {m_formatted}"
-        out = conn.send_command(cmd)
-        logger.debug(f"MAC search output: {out}")
-        interface = None
-        for line in out.splitlines():
-            if m_formatted in line:
-                parts = line.split()
-                for token in reversed(parts):
-                    if re.match(r"^(Gi|Fa|Te|Tw|Et|Ethernet|Po|Port-channel|Eth)\S*", token, re.IGNORECASE) or re.match(r"^[A-Za-z]+[0-9/]+$", token):
-                        interface = token
-                        break
-                if interface:
-                    break
-        mac_result = {"mac": m_formatted, "raw": out, "interface": interface, "site": site_name, "switch": switch_name}
-    finally:
-        conn.disconnect()
+    interface, out = lookup_mac_interface(device, m_formatted)
+    mac_result = {"mac": m_formatted, "raw": out, "interface": interface, "site": site_name, "switch": switch_name}
     if not interface:
         flash("MAC nicht in MAC‑Tabelle des Switches gefunden")
         return redirect(url_for("switch_detail", site_name=site_name, name=switch_name))
@@ -1,13 +1,37 @@
+import os
 
 # Flask configuration
 APP_HOST = "0.0.0.0"
 APP_PORT = 5000
-DEBUG = True
+DEBUG = os.environ.get("WEBCABLEDIAG_DEBUG", "0") == "1"  # never enable in production
 SECRET_KEY = "change_this_secret_change_in_prod"
 
 # Cache configuration
 TDR_CACHE_TTL = 60  # seconds
 INTERFACES_CACHE_TTL = 30  # seconds
+MAC_CACHE_TTL = 60  # seconds
+
+# Cache backend: "memory" (per-process TTLCache, for dev), "disk" (diskcache, shared between workers and restarts)
+# or "redis" (shared between workers and hosts, also deduplicates SSH calls across them)
+CACHE_BACKEND = os.environ.get("WEBCABLEDIAG_CACHE_BACKEND", "memory")
+CACHE_DIR = os.environ.get("WEBCABLEDIAG_CACHE_DIR", "/var/lib/webcablediag")
+CACHE_SIZE_LIMIT = 100 * 1024 * 1024  # bytes per disk cache
+REDIS_URL = os.environ.get("WEBCABLEDIAG_REDIS_URL", "redis://localhost:6379/0")
+SINGLEFLIGHT_LOCK_TTL = 30  # seconds a lock outlives a crashed holder, extended while held
+
+# Fetch interface lists of all access switches at startup and keep them fresh (opens SSH to every switch)
+PREFETCH_ON_STARTUP = os.environ.get("WEBCABLEDIAG_PREFETCH_ON_STARTUP", "0") == "1"
+
+# TDR result polling, backoff delays in seconds between "show cable-diagnostics tdr" calls
+TDR_POLL_DELAYS = (0.5, 1, 2, 4, 4, 4)
 
 # Thread pool configuration
 MAX_WORKERS = 5
+
+# SSH connection pool configuration
+CONNECTION_POOL_IDLE_TIMEOUT = 300  # seconds a session may sit unused
+CONNECTION_POOL_MAX_AGE = 3600  # seconds before a session is recycled
+CONNECTION_POOL_MAX_SIZE = 100  # idle sessions kept across all devices
+# Per switch and worker process, mind the switch's VTY lines (default "line vty 0 4")
+CONNECTION_POOL_MAX_IDLE_PER_HOST = 1  # idle sessions kept per switch
+CONNECTION_POOL_MAX_ACTIVE_PER_HOST = 2  # sessions open at the same time per switch, others wait
@@ -0,0 +1,10 @@
+# gunicorn configuration, start with: gunicorn app:app
+from config import APP_HOST, APP_PORT
+
+bind = f"{APP_HOST}:{APP_PORT}"
+workers = 4
+worker_class = "gthread"
+threads = 16
+# gthread workers heartbeat from their main loop, so this only restarts hung workers;
+# it does not limit how long a request or TDR event stream may take
+timeout = 60